@@ -5,7 +5,7 @@ Various pyplot related utils.
 import math
 import numpy as np
 import matplotlib.pyplot as plt
-import scipy.stats as stats
+from stats import summarize
 
 def getPalette(n,colormap = plt.cm.rainbow, dx =0.1):
     """Returns a custom list of colors n colors that work well when used together on a plot.
@@ -121,18 +121,19 @@ def customboxplot(data,x=1,percentiles=(25,50,75),dataplot=True,mean=False,banno
         ax=plt.gca()
 
     #Scatter plot the data
-    xjitter = (np.random.rand(len(data))*2-[1]*len(data))*jitter/2.0
     if dataplot:
+        xjitter = (np.random.rand(len(data))*2-1)*jitter/2.0
         if label == None:
             ax.plot([x]*len(data)+xjitter,data,dcolor+dmarker,alpha=dalpha)
         else:
             ax.plot([x]*len(data)+xjitter,data,color=dcolor,linestyle='',marker=dmarker,alpha=dalpha,label=label)
 
     #Plot the box
-    lowbox = stats.scoreatpercentile(data, percentiles[0])
-    midline = stats.scoreatpercentile(data, percentiles[1])
-    meanline = np.mean(data)
-    highbox = stats.scoreatpercentile(data, percentiles[2])
+    summary = summarize(data)
+    lowbox = summary.percentile(percentiles[0])
+    midline = summary.percentile(percentiles[1])
+    meanline = summary.mean()
+    highbox = summary.percentile(percentiles[2])
 
     boxside = bwidth/2.0
 
@@ -170,8 +171,7 @@ def plotECDF(data,color='k',linewidth=1.0,linestyle='-',label=None):
         linestyle -- the style of the plotted line.
         label -- the label of the plot line, for legend purpose.
     """
-    x = sorted(data)
-    y = np.array(range(1,len(x)+1))/float(len(x))
+    x,y = summarize(data).ecdf()
     if label == None:
         return plt.plot(x,y,color=color,linewidth=linewidth,linestyle=linestyle)
     else:
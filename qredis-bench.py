@@ -0,0 +1,238 @@
+"""
+Throughput benchmark of the qredis structures.
+
+Starts a throwaway local redis-server (or uses an existing server, an in-process
+fakeredis stand-in, or the shared memory backend) and measures items/sec and p50/p99 latencies of put and get
+for every benchmark case. Results can be written as JSON and compared against a
+previously saved baseline.
+
+	python qredis-bench.py -n 10000 --output bench.json
+	python qredis-bench.py -n 10000 --baseline bench.json
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import string
+import subprocess
+import sys
+import time
+import timeit
+
+import redis
+
+import qredis
+
+NAMESPACE = 'qredis-bench'
+
+def startServer(executable):
+	"""Start a local redis-server without persistence on a free port, return the process and its port."""
+	sock = socket.socket()
+	sock.bind(('localhost',0))
+	port = sock.getsockname()[1]
+	sock.close()
+
+	devnull = open(os.devnull,'w')
+	process = subprocess.Popen([executable,'--port',str(port),'--save','','--appendonly','no'],stdout=devnull,stderr=devnull)
+
+	db = redis.StrictRedis(port=port)
+	for i in range(100):
+		try:
+			db.ping()
+			return process, port
+		except redis.ConnectionError:
+			if process.poll() != None:
+				break
+			time.sleep(0.05)
+	process.kill()
+	raise Exception('Could not start redis server "%s" on port %d.' % (executable,port))
+
+def useFakeServer():
+	"""Replace the redis client used by qredis with an in-process fakeredis stand-in."""
+	import fakeredis
+	server = fakeredis.FakeServer()
+	qredis.redis.StrictRedis = lambda **redis_kwargs : fakeredis.FakeStrictRedis(server=server)
+
+def makeItems(n,size,encoded):
+	"""Return n distinct items with a random payload of the given size.
+
+	Encoded items are lists that go through the JSON and zlib encoders (the latter evaluates
+	the decoded string), the other items are their string representation.
+	"""
+	payload = ''.join(random.choice(string.ascii_letters) for i in range(size))
+	items = [[i,payload] for i in range(n)]
+	if not encoded:
+		items = [str(item) for item in items]
+	return items
+
+def percentile(values,q):
+	"""Return the q-th percentile of the sorted values."""
+	return values[int(round(q/100.0*(len(values)-1)))]
+
+def summarize(latencies,seconds):
+	"""Return throughput and latency summary of a benchmark phase."""
+	latencies = sorted(latencies)
+	return {
+		'ops_per_sec' : len(latencies)/seconds,
+		'p50_us' : percentile(latencies,50)*1e6,
+		'p99_us' : percentile(latencies,99)*1e6,
+		}
+
+def runCase(makeStructure,items,batch=None):
+	"""Put all the items in a fresh structure then get them back, timing every operation.
+
+	If batch is provided, items are gotten batch at a time with getmany and their latency
+	is amortized over the batch.
+	"""
+	structure = makeStructure()
+	timer = timeit.default_timer
+
+	latencies = []
+	start = timer()
+	for item in items:
+		t = timer()
+		structure.put(item)
+		latencies.append(timer()-t)
+	put = summarize(latencies,timer()-start)
+
+	#Gets do not block so that structures spreading items randomly (non preserving MultiStruct) drain;
+	#the latency of an item includes the misses preceding it.
+	latencies = []
+	misses = 0
+	start = timer()
+	t = timer()
+	while len(latencies) < len(items):
+		if batch == None:
+			gotten = 1 if structure.get(block=False) != None else 0
+		else:
+			gotten = len(structure.getmany(batch,block=False))
+		if gotten == 0:
+			misses += 1
+		else:
+			latencies += [(timer()-t)/gotten]*gotten
+			t = timer()
+	get = summarize(latencies,timer()-start)
+	get['misses'] = misses
+
+	return put, get
+
+def cases(sizes,redis_kwargs):
+	"""Generate (name,parameters,structure factory,encoded) benchmark cases."""
+
+	def queue():
+		return qredis.Queue(namespace=NAMESPACE+':queue',**redis_kwargs)
+
+	def stack():
+		return qredis.Stack(namespace=NAMESPACE+':stack',**redis_kwargs)
+
+	for size in sizes:
+		yield 'queue-%d' % size, {'structure':'Queue','size':size}, queue, False
+		yield 'stack-%d' % size, {'structure':'Stack','size':size}, stack, False
+
+	encoders = [('json',qredis.JSONEncoder),('zlib',qredis.ZlibEncoder)]
+	for name, encoder in encoders:
+		for size in sizes:
+			yield 'encoder-%s-%d' % (name,size), {'structure':'Queue','encoder':name,'size':size}, lambda encoder=encoder : qredis.EncoderDecorator(queue(),encoder()), True
+
+	size = sizes[0]
+	for shards in [2,4,8]:
+		for preserve in [False,True]:
+			n = shards+1 if preserve else shards
+			yield 'multistruct-%d-%s' % (shards,'preserve' if preserve else 'random'), {'structure':'MultiStruct','shards':shards,'preserve':preserve,'size':size}, lambda n=n, preserve=preserve : qredis.MultiStruct([queue() for i in range(n)],preserve=preserve), False
+
+	for dedup in ['bloom','exact']:
+		yield 'multistruct-4-dedup-%s' % dedup, {'structure':'MultiStruct','shards':4,'preserve':False,'dedup':dedup,'size':size}, lambda dedup=dedup : qredis.MultiStruct([queue() for i in range(4)],dedup=dedup), False
+
+	for count in [1,10,100]:
+		yield 'batch-streamqueue-%d' % count, {'structure':'StreamQueue','count':count,'size':size}, lambda count=count : qredis.StreamQueue(namespace=NAMESPACE+':streamqueue',count=count,**redis_kwargs), False
+
+	for batch in [None,10,100]:
+		yield 'batch-priorityqueue-%s' % (batch or 'single'), {'structure':'PriorityQueue','batch':batch,'size':size}, lambda : qredis.PriorityQueue(namespace=NAMESPACE+':priorityqueue',**redis_kwargs), False
+
+def compare(results,baseline):
+	"""Print the throughput of the results relative to the baseline's."""
+	baseline = dict((result['case'],result) for result in baseline['results'])
+	print
+	print '%-32s %12s %12s' % ('case','put ratio','get ratio')
+	for result in results:
+		if result['case'] not in baseline:
+			continue
+		base = baseline[result['case']]
+		print '%-32s %12.2f %12.2f' % (result['case'],result['put']['ops_per_sec']/base['put']['ops_per_sec'],result['get']['ops_per_sec']/base['get']['ops_per_sec'])
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark qredis structures throughput.')
+	parser.add_argument('-n',type=int,default=10000,help='number of items per case.')
+	parser.add_argument('--sizes',type=int,nargs='+',default=[16,256,4096,65536],help='payload sizes in bytes.')
+	parser.add_argument('--maxbytes',type=int,default=2**26,help='maximal total payload per case, fewer items are used for large payloads.')
+	parser.add_argument('--cases',default='',help='only run cases whose name contains this string.')
+	parser.add_argument('--server',default='redis-server',help='redis-server executable to start.')
+	parser.add_argument('--host',default=None,help='use the existing redis server on this host instead of starting one.')
+	parser.add_argument('--port',type=int,default=6379,help='port of the existing redis server.')
+	parser.add_argument('--fake',action='store_true',help='use an in-process fakeredis server (no network).')
+	parser.add_argument('--url',default=None,help='use the backend at this URL, e.g. "shm://" for shared memory.')
+	parser.add_argument('--output',default=None,help='write the results as JSON to this file.')
+	parser.add_argument('--baseline',default=None,help='compare the results to this JSON results file.')
+	parser.add_argument('--seed',type=int,default=0,help='seed of the payload generator.')
+	args = parser.parse_args()
+
+	random.seed(args.seed)
+
+	process = None
+	if args.fake:
+		useFakeServer()
+		redis_kwargs = {}
+		backend = 'fakeredis'
+	elif args.url != None:
+		#All the items of a case are put before they are gotten, so they must fit in a shared memory buffer.
+		if args.url.startswith('shm://') and 'capacity=' not in args.url:
+			args.url += ('&' if '?' in args.url else '?') + 'capacity=%d' % (4*args.maxbytes)
+		redis_kwargs = {'url':args.url}
+		backend = args.url
+	elif args.host != None:
+		redis_kwargs = {'host':args.host,'port':args.port}
+		backend = '%s:%d' % (args.host,args.port)
+	else:
+		process, port = startServer(args.server)
+		redis_kwargs = {'port':port}
+		backend = args.server
+
+	results = []
+	try:
+		print '%-32s %12s %10s %10s %12s %10s %10s' % ('case','put/s','put p50us','put p99us','get/s','get p50us','get p99us')
+		for name, parameters, makeStructure, encoded in cases(args.sizes,redis_kwargs):
+			if args.cases not in name:
+				continue
+			n = max(min(args.n,args.maxbytes/parameters['size']),1)
+			items = makeItems(n,parameters['size'],encoded)
+			try:
+				put, get = runCase(makeStructure,items,parameters.get('batch'))
+			except (ValueError,redis.ResponseError), e:
+				#Structures the backend does not support (e.g. streams on shared memory or fakeredis).
+				print '%-32s skipped: %s' % (name,e)
+				continue
+			finally:
+				db = qredis.connect(**redis_kwargs)
+				for key in db.scan_iter(match=NAMESPACE+':*'):
+					db.delete(key)
+			results.append({'case':name,'parameters':parameters,'put':put,'get':get})
+			print '%-32s %12.0f %10.1f %10.1f %12.0f %10.1f %10.1f' % (name,put['ops_per_sec'],put['p50_us'],put['p99_us'],get['ops_per_sec'],get['p50_us'],get['p99_us'])
+			sys.stdout.flush()
+	finally:
+		if process != None:
+			process.terminate()
+			process.wait()
+
+		#Results gathered so far are written even if a case failed.
+		output = {'backend':backend,'n':args.n,'results':results}
+		if args.output != None:
+			with open(args.output,'w') as f:
+				json.dump(output,f,indent=2,sort_keys=True)
+
+	if args.baseline != None:
+		with open(args.baseline) as f:
+			compare(results,json.load(f))
+
+if __name__ == '__main__':
+	main()
@@ -1,12 +1,566 @@
 import redis
 
 import random
+import collections
+import os
+import socket
+import threading
+import functools
+import bisect
+import timeit
+import time
+import mmap
+import fcntl
+import struct
+import fnmatch
+import select
+import errno
+import multiprocessing
+import math
 
 import json
 import zlib
 
 import mmh3
 
+#Instrumentation hooks, called with an @Operation after every structure operation.
+_hooks = []
+_local = threading.local()
+
+class Operation(object):
+	"""
+	Record of a single logical operation on a structure, as handed to instrumentation hooks.
+	Round trips of nested operations (e.g. the structures behind a MultiStruct) are added
+	to the operation that issued them.
+	"""
+
+	def __init__(self, structure, name):
+		"""
+		structure - the name of the structure's class.
+		name - the name of the operation (e.g. put, get, size, ...).
+		"""
+		self.structure = structure
+		self.name = name
+		#Wall clock time spent in the operation, including blocking.
+		self.seconds = None
+		#Number of round trips to the server.
+		self.roundtrips = 0
+		#Size of the item before and after encoding, and time spent encoding/decoding it (EncoderDecorator only).
+		self.rawbytes = None
+		self.encodedbytes = None
+		self.codecseconds = None
+
+def addHook(hook):
+	"""Register an instrumentation hook.
+
+	hook - a callable taking an @Operation, called after every structure operation
+		(see @MetricsRegistry). Instrumentation is disabled while no hook is registered.
+	"""
+	_hooks.append(hook)
+
+def removeHook(hook):
+	"""Unregister a previously registered instrumentation hook."""
+	_hooks.remove(hook)
+
+def _operations():
+	"""Return this thread's stack of operations in progress."""
+	try:
+		return _local.operations
+	except AttributeError:
+		_local.operations = []
+		return _local.operations
+
+def _current():
+	"""Return the innermost operation in progress, None if instrumentation is disabled."""
+	if not _hooks:
+		return None
+	operations = _operations()
+	if operations:
+		return operations[-1]
+	return None
+
+def _roundtrip(n=1):
+	"""Account for n round trips to the server in the operation in progress."""
+	if _hooks:
+		operations = _operations()
+		if operations:
+			operations[-1].roundtrips += n
+
+def _report(operation):
+	"""Hand the operation to the registered hooks, ignoring their errors so that they
+	neither fail an operation that already happened nor mask the operation's own error."""
+	for hook in list(_hooks):
+		try:
+			hook(operation)
+		except Exception:
+			pass
+
+def _instrumented(method):
+	"""Decorator reporting every call to a structure method as an @Operation to the registered hooks."""
+	@functools.wraps(method)
+	def wrapper(self, *args, **kwargs):
+		if not _hooks:
+			return method(self, *args, **kwargs)
+
+		operations = _operations()
+		operation = Operation(type(self).__name__,method.__name__)
+		operations.append(operation)
+		start = timeit.default_timer()
+		try:
+			return method(self, *args, **kwargs)
+		finally:
+			operation.seconds = timeit.default_timer() - start
+			operations.pop()
+			if operations:
+				operations[-1].roundtrips += operation.roundtrips
+			_report(operation)
+	return wrapper
+
+class MetricsRegistry(object):
+	"""
+	In-memory instrumentation hook aggregating structure operations into counters
+	and histograms, labeled by structure and operation.
+	"""
+
+	#Name, type and description of the aggregated metrics.
+	METRICS = [
+		('qredis_operations_total','counter','Number of structure operations.'),
+		('qredis_roundtrips_total','counter','Number of round trips to the server issued by structure operations.'),
+		('qredis_raw_bytes_total','counter','Size of items before encoding.'),
+		('qredis_encoded_bytes_total','counter','Size of items after encoding.'),
+		('qredis_operation_seconds','histogram','Latency of structure operations, including blocking time.'),
+		('qredis_codec_seconds','histogram','Time spent encoding and decoding items.'),
+		]
+
+	#Default latency histogram buckets upper bounds, in seconds.
+	BUCKETS = (0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+	def __init__(self, buckets=None):
+		"""
+		buckets - the latency histograms buckets upper bounds, in seconds, defaults to @BUCKETS.
+		"""
+		if buckets == None:
+			buckets = MetricsRegistry.BUCKETS
+		self.__buckets = tuple(sorted(buckets))
+		self.__lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		"""Forget all recorded operations."""
+		with self.__lock:
+			#(metric,structure,operation) -> value for counters, [bucket counts,sum,count] for histograms.
+			self.__values = {}
+
+	def __call__(self, operation):
+		labels = (operation.structure,operation.name)
+		with self.__lock:
+			self.__increment('qredis_operations_total',labels,1)
+			self.__increment('qredis_roundtrips_total',labels,operation.roundtrips)
+			self.__observe('qredis_operation_seconds',labels,operation.seconds)
+			if operation.rawbytes != None:
+				self.__increment('qredis_raw_bytes_total',labels,operation.rawbytes)
+			if operation.encodedbytes != None:
+				self.__increment('qredis_encoded_bytes_total',labels,operation.encodedbytes)
+			if operation.codecseconds != None:
+				self.__observe('qredis_codec_seconds',labels,operation.codecseconds)
+
+	def __increment(self, metric, labels, value):
+		key = (metric,)+labels
+		self.__values[key] = self.__values.get(key,0) + value
+
+	def __observe(self, metric, labels, value):
+		key = (metric,)+labels
+		if key not in self.__values:
+			self.__values[key] = [[0]*(len(self.__buckets)+1),0.0,0]
+		histogram = self.__values[key]
+		histogram[0][bisect.bisect_left(self.__buckets,value)] += 1
+		histogram[1] += value
+		histogram[2] += 1
+
+	def value(self, metric, structure, operation):
+		"""Return the value of a counter, or the (sum,count) pair of a histogram, for the given labels."""
+		with self.__lock:
+			value = self.__values.get((metric,structure,operation))
+		if value == None:
+			if dict((name,metrictype) for name, metrictype, description in MetricsRegistry.METRICS).get(metric) == 'histogram':
+				return (0.0,0)
+			return 0
+		if isinstance(value,list):
+			return (value[1],value[2])
+		return value
+
+	def render(self):
+		"""Return the recorded metrics in the Prometheus text exposition format."""
+		lines = []
+		with self.__lock:
+			for metric, metrictype, description in MetricsRegistry.METRICS:
+				keys = sorted(key for key in self.__values if key[0] == metric)
+				if not keys:
+					continue
+				lines.append('# HELP %s %s' % (metric,description))
+				lines.append('# TYPE %s %s' % (metric,metrictype))
+				for key in keys:
+					labels = 'structure="%s",operation="%s"' % key[1:]
+					value = self.__values[key]
+					if metrictype == 'counter':
+						lines.append('%s{%s} %s' % (metric,labels,value))
+					else:
+						counts, total, count = value
+						cumulative = 0
+						for bound, bucketcount in zip(self.__buckets+(float('inf'),),counts):
+							cumulative += bucketcount
+							le = '+Inf' if bound == float('inf') else repr(float(bound))
+							lines.append('%s_bucket{%s,le="%s"} %d' % (metric,labels,le,cumulative))
+						lines.append('%s_sum{%s} %r' % (metric,labels,total))
+						lines.append('%s_count{%s} %d' % (metric,labels,count))
+		return '\n'.join(lines)+'\n'
+
+class _RingBuffer(object):
+	"""
+	Double ended ring buffer of strings in a memory mapped file, shared by all the processes
+	mapping the same file. Records are framed by their length on both sides so that they can
+	be removed from either end. Access is serialized with an exclusive lock on the file.
+
+	Processes waiting for data (or room) register in the header and wait on a FIFO next to the
+	buffer file, in which the process that appends (or pops) writes one byte per waiting process.
+	"""
+
+	#Header with the data capacity, the offset of the first record, the number of used bytes, the number
+	#of records, and the number of processes waiting for data and for room.
+	HEADER = struct.Struct('<QQQQQQ')
+	LENGTH = struct.Struct('<I')
+	DATAWAITERS = 4
+	ROOMWAITERS = 5
+
+	def __init__(self, path, capacity):
+		"""
+		path - the file backing the buffer, created if it does not exist.
+		capacity - the data capacity in bytes of a newly created buffer; an existing buffer keeps its own.
+		"""
+		self.__closed = True
+		self.__lock = threading.Lock()
+		self.__fd = os.open(path,os.O_RDWR|os.O_CREAT,0600)
+		try:
+			fcntl.flock(self.__fd,fcntl.LOCK_EX)
+			try:
+				if os.fstat(self.__fd).st_size == 0:
+					os.ftruncate(self.__fd,_RingBuffer.HEADER.size+capacity)
+					os.write(self.__fd,_RingBuffer.HEADER.pack(capacity,0,0,0,0,0))
+				self.__mm = mmap.mmap(self.__fd,os.fstat(self.__fd).st_size)
+			finally:
+				fcntl.flock(self.__fd,fcntl.LOCK_UN)
+		except:
+			os.close(self.__fd)
+			raise
+		self.capacity = _RingBuffer.HEADER.unpack_from(self.__mm,0)[0]
+
+		#FIFOs signaling data and room, opened for reading and writing so that they never block
+		#and keep the signals written while nobody waits.
+		self.__fifos = []
+		self.__closed = False
+		for path in _RingBuffer.fifopaths(path):
+			try:
+				os.mkfifo(path,0600)
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					self.close()
+					raise
+			self.__fifos.append(os.open(path,os.O_RDWR|os.O_NONBLOCK))
+
+	@staticmethod
+	def fifopaths(path):
+		"""Return the paths of the data and room FIFOs of the buffer backed by the given file."""
+		directory, filename = os.path.split(path)
+		return [os.path.join(directory,'.%s.%s' % (filename,suffix)) for suffix in ['data','room']]
+
+	def __acquire(self):
+		self.__lock.acquire()
+		fcntl.flock(self.__fd,fcntl.LOCK_EX)
+
+	def __release(self):
+		fcntl.flock(self.__fd,fcntl.LOCK_UN)
+		self.__lock.release()
+
+	def __write(self, offset, data):
+		start = _RingBuffer.HEADER.size
+		offset %= self.capacity
+		first = min(len(data),self.capacity-offset)
+		self.__mm[start+offset:start+offset+first] = data[:first]
+		self.__mm[start:start+len(data)-first] = data[first:]
+
+	def __read(self, offset, n):
+		start = _RingBuffer.HEADER.size
+		offset %= self.capacity
+		first = min(n,self.capacity-offset)
+		return self.__mm[start+offset:start+offset+first] + self.__mm[start:start+n-first]
+
+	def __header(self):
+		return list(_RingBuffer.HEADER.unpack_from(self.__mm,0))
+
+	def __signal(self, header, room):
+		"""Wake up the processes waiting for room (or data), with the header lock held."""
+		waiters = header[_RingBuffer.ROOMWAITERS if room else _RingBuffer.DATAWAITERS]
+		if waiters > 0:
+			try:
+				os.write(self.__fifos[room],'x'*waiters)
+			except OSError, e:
+				#A full FIFO already wakes up everyone.
+				if e.errno != errno.EAGAIN:
+					raise
+
+	def __len__(self):
+		self.__acquire()
+		try:
+			return self.__header()[3]
+		finally:
+			self.__release()
+
+	def append(self, data, wait=False):
+		"""Append data at the end of the buffer, return False if there is not enough room.
+		If wait is True, also register as waiting for room in that case (see @wait)."""
+		size = len(data)+2*_RingBuffer.LENGTH.size
+		if size > self.capacity:
+			raise ValueError('Item of %d bytes does not fit in shared memory buffer of %d bytes.' % (len(data),self.capacity))
+		length = _RingBuffer.LENGTH.pack(len(data))
+
+		self.__acquire()
+		try:
+			header = self.__header()
+			capacity, head, used, count = header[:4]
+			if used+size > capacity:
+				if wait:
+					header[_RingBuffer.ROOMWAITERS] += 1
+					_RingBuffer.HEADER.pack_into(self.__mm,0,*header)
+				return False
+			self.__write(head+used,length+data+length)
+			header[2:4] = [used+size,count+1]
+			_RingBuffer.HEADER.pack_into(self.__mm,0,*header)
+			self.__signal(header,False)
+			return True
+		finally:
+			self.__release()
+
+	def pop(self, left, wait=False):
+		"""Remove and return the data at the start (left) or end of the buffer, None if it is empty.
+		If wait is True, also register as waiting for data in that case (see @wait)."""
+		self.__acquire()
+		try:
+			header = self.__header()
+			capacity, head, used, count = header[:4]
+			if count == 0:
+				if wait:
+					header[_RingBuffer.DATAWAITERS] += 1
+					_RingBuffer.HEADER.pack_into(self.__mm,0,*header)
+				return None
+			if left:
+				n = _RingBuffer.LENGTH.unpack(self.__read(head,_RingBuffer.LENGTH.size))[0]
+				data = self.__read(head+_RingBuffer.LENGTH.size,n)
+				head = (head+n+2*_RingBuffer.LENGTH.size) % capacity
+			else:
+				tail = head+used
+				n = _RingBuffer.LENGTH.unpack(self.__read(tail-_RingBuffer.LENGTH.size,_RingBuffer.LENGTH.size))[0]
+				data = self.__read(tail-n-_RingBuffer.LENGTH.size,n)
+			used -= n+2*_RingBuffer.LENGTH.size
+			count -= 1
+			if count == 0:
+				head = 0
+			header[1:4] = [head,used,count]
+			_RingBuffer.HEADER.pack_into(self.__mm,0,*header)
+			self.__signal(header,True)
+			return data
+		finally:
+			self.__release()
+
+	def fifo(self, room):
+		"""Return the file descriptor to select on to wait for room (or data)."""
+		return self.__fifos[room]
+
+	def unwait(self, room, signaled):
+		"""Unregister as waiting for room (or data), consuming the signal if the FIFO was ready."""
+		self.__acquire()
+		try:
+			header = self.__header()
+			index = _RingBuffer.ROOMWAITERS if room else _RingBuffer.DATAWAITERS
+			header[index] = max(header[index]-1,0)
+			_RingBuffer.HEADER.pack_into(self.__mm,0,*header)
+		finally:
+			self.__release()
+		if signaled:
+			try:
+				os.read(self.__fifos[room],1)
+			except OSError, e:
+				if e.errno != errno.EAGAIN:
+					raise
+
+	def close(self):
+		if self.__closed:
+			return
+		self.__closed = True
+		self.__mm.close()
+		os.close(self.__fd)
+		for fd in self.__fifos:
+			os.close(fd)
+
+	def __del__(self):
+		self.close()
+
+class SharedMemoryClient(object):
+	"""
+	Local stand-in for the redis client implementing the list commands used by @Queue and @Stack
+	(and hence @MultiStruct) on top of shared memory ring buffers, one per key, so that processes
+	on the same host exchange items without going through the network.
+
+	Blocking commands sleep until they are woken up through a FIFO by the process that pushes
+	(or, for a push to a full buffer, pops) an item, which takes a few microseconds. They also
+	retry at least every poll seconds, which bounds the delay should a wakeup be missed (e.g.
+	because a waiting process was killed while registered).
+	"""
+
+	def __init__(self, directory='/dev/shm', capacity=2**20, poll=0.1):
+		"""
+		directory - the directory of the files backing the buffers; /dev/shm is memory backed on Linux.
+		capacity - the capacity in bytes of the buffers created by this client.
+		poll - the maximal time, in seconds, a blocking command waits before retrying.
+		"""
+		self.directory = directory
+		self.capacity = capacity
+		self.poll = poll
+		self.__buffers = {}
+
+	@staticmethod
+	def from_url(url):
+		"""Create a client from a 'shm://[directory][?capacity=<bytes>][&poll=<seconds>]' URL."""
+		if not url.startswith('shm://'):
+			raise ValueError('Shared memory URL "%s" does not start with "shm://".' % url)
+		directory, _, query = url[len('shm://'):].partition('?')
+		kwargs = {}
+		if directory:
+			kwargs['directory'] = directory
+		for parameter in query.split('&'):
+			if not parameter:
+				continue
+			name, _, value = parameter.partition('=')
+			if name == 'capacity':
+				kwargs['capacity'] = int(value)
+			elif name == 'poll':
+				kwargs['poll'] = float(value)
+			else:
+				raise ValueError('Unknown parameter "%s" in shared memory URL "%s".' % (name,url))
+		return SharedMemoryClient(**kwargs)
+
+	def __path(self, key):
+		return os.path.join(self.directory,'qredis-'+key.replace('/','%2F'))
+
+	def __buffer(self, key):
+		if key not in self.__buffers:
+			self.__buffers[key] = _RingBuffer(self.__path(key),self.capacity)
+		return self.__buffers[key]
+
+	def __sleep(self, buffers, room, deadline=None):
+		"""Wait until one of the buffers, on which we are registered as waiting, signals room (or data),
+		at most poll seconds or until the deadline. Unregister from all the buffers."""
+		timeout = self.poll
+		if deadline != None:
+			timeout = max(min(timeout,deadline-time.time()),0)
+		ready = []
+		try:
+			ready = select.select([buf.fifo(room) for buf in buffers],[],[],timeout)[0]
+		finally:
+			for buf in buffers:
+				buf.unwait(room,buf.fifo(room) in ready)
+
+	def __wait(self, keys, timeout, left):
+		"""Pop from the first of the buffers with the given keys that has some data, waiting for
+		some if they are all empty, until timeout."""
+		if isinstance(keys,basestring):
+			keys = [keys]
+		deadline = None
+		if timeout:
+			deadline = time.time()+timeout
+		while True:
+			waiting = []
+			for key in keys:
+				buf = self.__buffer(key)
+				data = buf.pop(left,wait=True)
+				if data != None:
+					for other in waiting:
+						other.unwait(False,False)
+					return (key,data)
+				waiting.append(buf)
+			if deadline != None and time.time() >= deadline:
+				for buf in waiting:
+					buf.unwait(False,False)
+				return None
+			self.__sleep(waiting,False,deadline)
+
+	def ping(self):
+		if not os.path.isdir(self.directory):
+			raise ValueError('Shared memory directory "%s" does not exist.' % self.directory)
+		return True
+
+	def llen(self, key):
+		return len(self.__buffer(key))
+
+	def rpush(self, key, *values):
+		buf = self.__buffer(key)
+		for value in values:
+			value = str(value)
+			while not buf.append(value,wait=True):
+				self.__sleep([buf],True)
+		return len(buf)
+
+	def lpop(self, key):
+		return self.__buffer(key).pop(True)
+
+	def rpop(self, key):
+		return self.__buffer(key).pop(False)
+
+	def blpop(self, keys, timeout=0):
+		return self.__wait(keys,timeout,True)
+
+	def brpop(self, keys, timeout=0):
+		return self.__wait(keys,timeout,False)
+
+	def delete(self, *keys):
+		deleted = 0
+		for key in keys:
+			if key in self.__buffers:
+				self.__buffers.pop(key).close()
+			path = self.__path(key)
+			if os.path.exists(path):
+				os.remove(path)
+				deleted += 1
+			for fifopath in _RingBuffer.fifopaths(path):
+				if os.path.exists(fifopath):
+					os.remove(fifopath)
+		return deleted
+
+	def scan_iter(self, match='*'):
+		for filename in os.listdir(self.directory):
+			if filename.startswith('qredis-'):
+				key = filename[len('qredis-'):].replace('%2F','/')
+				if fnmatch.fnmatchcase(key,match):
+					yield key
+
+	def close(self):
+		"""Unmap all the buffers opened by this client."""
+		for buf in self.__buffers.values():
+			buf.close()
+		self.__buffers.clear()
+
+def connect(url=None, **redis_kwargs):
+	"""Return a client for the structures.
+
+	url - if it starts with 'shm://', a @SharedMemoryClient for the local host (see @SharedMemoryClient.from_url),
+		otherwise a redis URL (e.g. 'redis://localhost:6379/0'). If 'None', the redis arguments are used.
+	redis_kwargs - the redis arguments to create a redis connection.
+	"""
+	if url != None and url.startswith('shm://'):
+		return SharedMemoryClient.from_url(url)
+	if url != None:
+		return redis.StrictRedis.from_url(url,**redis_kwargs)
+	return redis.StrictRedis(**redis_kwargs)
+
 class _Structure(object):
 	"""
 	Simple limited access data structure with redis backend. 
@@ -15,16 +569,50 @@ class _Structure(object):
 	of the character '0' and the integer 0 are the same).
 	"""
 
-	def __init__(self, name, namespace, **redis_kwargs):
+	#Atomically record the item (KEYS[1], ARGV[1]) in a filter (KEYS[2]) and push it if it was not already there.
+	#With bloom filter positions (ARGV[3:]) the filter is a bitmap, and the item is also looked up in the previous
+	#bitmap (KEYS[3]) if any, otherwise it is a marker for that single item. Either way the filter key expires after ARGV[2] seconds.
+	PUTUNIQUE = """
+	local new = false
+	if #ARGV > 2 then
+		local previous = KEYS[3] ~= nil
+		for i = 3, #ARGV do
+			if redis.call('GETBIT', KEYS[2], ARGV[i]) == 0 then
+				new = true
+			end
+			if previous and redis.call('GETBIT', KEYS[3], ARGV[i]) == 0 then
+				previous = false
+			end
+		end
+		new = new and not previous
+		if new then
+			for i = 3, #ARGV do
+				redis.call('SETBIT', KEYS[2], ARGV[i], 1)
+			end
+			redis.call('EXPIRE', KEYS[2], ARGV[2])
+		end
+	else
+		new = redis.call('SET', KEYS[2], 1, 'NX', 'EX', ARGV[2])
+	end
+	if new then
+		redis.call('RPUSH', KEYS[1], ARGV[1])
+		return 1
+	end
+	return 0
+	"""
+
+	def __init__(self, name, namespace, url=None, **redis_kwargs):
 		"""Create a structure.
 
 		name - the structure's name, used to identify its key in redis.
 		namespace - the stucture's namespace, usually to identify the 
 			class of structure (e.g. queue, stack, ...)
+		url - optional URL of the backend, either a redis URL or 'shm://' to exchange
+			items through shared memory on the local host (see @connect).
 		redis_kwargs - the redis arguments to create a redis connection.
 			Important defaults are host='localhost', port=6379, password=None.
 		"""
-		self.db = redis.StrictRedis(**redis_kwargs)
+		self.db = connect(url,**redis_kwargs)
 
 		#Check if the db is alive.
 		self.db.ping()
@@ -33,21 +621,73 @@ class _Structure(object):
 
 		self.key = key
 
+		self.__putunique = None
+		if not isinstance(self.db,SharedMemoryClient):
+			self.__putunique = self.db.register_script(_Structure.PUTUNIQUE)
+
+	@_instrumented
 	def size(self):
 		"""Return the approximate size of the queue."""
+		_roundtrip()
 		return self.db.llen(self.key)
 
+	@_instrumented
 	def empty(self):
 		"""Return True if the queue is empty, False otherwise."""
 		return self.size() == 0
 
+	@_instrumented
 	def put(self, item):
 		"""Put item into the queue without blocking."""
 		self.db.rpush(self.key, item)
+		_roundtrip()
+
+	@_instrumented
+	def putunique(self, item, filtername, ttl, positions=None, previous=None):
+		"""Put item into the queue without blocking unless the filter reports it as already seen,
+		atomically with updating the filter. Return True if the item was put, False otherwise.
+
+		filtername - the name of the filter, stored next to the structure's key.
+		ttl - the time to live of the filter, in seconds.
+		positions - the item's bloom filter bit positions, if 'None' the filter is an exact
+			marker for that single item.
+		previous - the name of the previous bloom filter, in which the item is also looked up
+			but not recorded.
+		"""
+		if not self._canputunique():
+			raise NotImplementedError('%s does not support deduplicating put.' % type(self).__name__)
+		keys = [self.key,'%s:%s' % (self.key,filtername)]
+		if previous != None:
+			keys.append('%s:%s' % (self.key,previous))
+		args = [item,ttl]
+		if positions != None:
+			args += positions
+		put = self.__putunique(keys=keys,args=args)
+		_roundtrip()
+		return put == 1
+
+	def _canputunique(self):
+		"""Return whether the structure supports @putunique."""
+		return self.__putunique != None
 
 	def get(self, block=True, timeout=None):
 		raise NotImplementedException('Abstract class _Structure does not implement get.')
 
+	@_instrumented
+	def getmany(self, n, block=True, timeout=None):
+		"""Remove and return a list of at most n items.
+
+		Only blocks (see @get) until the first item is available, the list is
+		then filled with the items readily available."""
+		items = []
+		item = self.get(block,timeout)
+		while item != None:
+			items.append(item)
+			if len(items) >= n:
+				break
+			item = self.get(False)
+		return items
+
 class Queue(_Structure):
 	"""
 	Implements structure that gets the opposite side it puts.
@@ -63,6 +703,7 @@ class Queue(_Structure):
 
 		_Structure.__init__(self,name,namespace,**redis_kwargs)
 
+	@_instrumented
 	def get(self, block=True, timeout=None):
 		"""Remove and return an item from the queue. 
 
@@ -81,6 +722,7 @@ class Queue(_Structure):
 				item = item
 			else:
 				item = None
+		_roundtrip()
 		return item
 
 class Stack(_Structure):
@@ -98,6 +740,7 @@ class Stack(_Structure):
 
 		_Structure.__init__(self,name,namespace,**redis_kwargs)
 
+	@_instrumented
 	def get(self, block=True, timeout=None):
 		"""Remove and return an item from the stack. 
 
@@ -116,9 +759,303 @@ class Stack(_Structure):
 				item = item
 			else:
 				item = None
+		_roundtrip()
+
+		return item
+
+class StreamQueue(_Structure):
+	"""
+	Implements a queue on top of a redis stream read through a consumer group.
+
+	Unlike @Queue, an item handed out by 'get' stays in the stream's pending
+	entries list until it is acknowledged, so items held by a crashed consumer
+	are eventually claimed back by another consumer (at-least-once delivery).
+	Entries are read from the server in batches and served locally. Acknowledged
+	entries stay in the stream, for other consumer groups or replay, until it is
+	trimmed (see maxlen).
+	"""
+	__index = 0
+
+	def __init__(self, name = None, namespace='streamqueue', group='default', consumer=None, count=100, maxlen=None, claimidle=60000, autoack=True, **redis_kwargs):
+		"""The default connection parameters are: host='localhost', port=6379, db=0
+
+		group - the consumer group to read through; consumers sharing a group share the items.
+		consumer - the name of this consumer within the group, defaults to 'hostname:pid'.
+		count - the maximal number of entries to fetch from the server at once.
+		maxlen - approximate maximal length of the stream ('MAXLEN ~'), if 'None' the stream is not trimmed.
+		claimidle - time in milliseconds after which another consumer's pending entry is considered stale and claimed.
+		autoack - whether delivered entries are acknowledged automatically once the next batch is fetched.
+			If 'False', call @ack once delivered items have been processed.
+		"""
+
+		if name == None:
+			name = 'default%d' % StreamQueue.__index
+			StreamQueue.__index+=1
+
+		_Structure.__init__(self,name,namespace,**redis_kwargs)
+		if isinstance(self.db,SharedMemoryClient):
+			raise ValueError('StreamQueue requires a redis backend.')
+
+		if consumer == None:
+			consumer = '%s:%d' % (socket.gethostname(),os.getpid())
+
+		self.group = group
+		self.consumer = consumer
+
+		self.__count = count
+		self.__maxlen = maxlen
+		self.__claimidle = claimidle
+		self.__autoack = autoack
+
+		#Entries fetched from the server but not yet handed out, and entries handed out but not yet acknowledged.
+		self.__buffer = collections.deque()
+		self.__delivered = []
+
+		#Time of the last check for stale entries.
+		self.__lastclaim = None
+
+		try:
+			self.db.xgroup_create(self.key,self.group,id='0',mkstream=True)
+		except redis.ResponseError, e:
+			if not str(e).startswith('BUSYGROUP'):
+				raise
+
+	@staticmethod
+	def __after(entryid):
+		"""Return the smallest entry id following the given one, to start a range after it
+		(exclusive ranges require redis 6.2)."""
+		milliseconds, sequence = entryid.split('-')
+		return '%s-%d' % (milliseconds,int(sequence)+1)
+
+	def __group(self):
+		"""Return the information of the consumer group, None if it does not exist."""
+		groups = self.db.xinfo_groups(self.key)
+		_roundtrip()
+		for group in groups:
+			if group['name'] == self.group:
+				return group
+		return None
+
+	@_instrumented
+	def size(self):
+		"""Return the approximate number of unacknowledged items in the queue, that is the
+		number of entries pending in the group plus the number not yet delivered to it.
+
+		The group's lag is only reported by redis 7 and later (and not after some trimming), otherwise
+		the undelivered entries are fetched to be counted, in time linear in their number. Use @empty
+		to check whether the queue is empty."""
+		group = self.__group()
+		if group == None:
+			return 0
+
+		lag = group.get('lag')
+		if lag == None:
+			lag = len(self.db.xrange(self.key,min=StreamQueue.__after(group['last-delivered-id']),max='+'))
+			_roundtrip()
+		return group['pending'] + lag
+
+	@_instrumented
+	def empty(self):
+		"""Return True if the queue has no unacknowledged item, False otherwise."""
+		group = self.__group()
+		if group == None:
+			return True
+		if group['pending'] > 0:
+			return False
+		if group.get('lag') != None:
+			return group['lag'] == 0
+		entries = self.db.xrange(self.key,min=StreamQueue.__after(group['last-delivered-id']),max='+',count=1)
+		_roundtrip()
+		return len(entries) == 0
+
+	@_instrumented
+	def put(self, item):
+		"""Put item into the queue without blocking."""
+		self.db.xadd(self.key,{'item':item},maxlen=self.__maxlen,approximate=True)
+		_roundtrip()
+
+	def _canputunique(self):
+		return False
+
+	@_instrumented
+	def ack(self):
+		"""Acknowledge all the items delivered so far."""
+		if self.__delivered:
+			pipe = self.db.pipeline(transaction=False)
+			self.__ack(pipe)
+			pipe.execute()
+			_roundtrip()
+
+	def __ack(self, pipe):
+		pipe.xack(self.key,self.group,*self.__delivered)
+		self.__delivered = []
+
+	def __claim(self):
+		"""Claim stale entries pending on other consumers of the group into the buffer,
+		checking for them at most once every claimidle milliseconds."""
+		now = time.time()
+		if self.__lastclaim != None and (now-self.__lastclaim)*1000 < self.__claimidle:
+			return
+		self.__lastclaim = now
+
+		pending = self.db.xpending_range(self.key,self.group,'-','+',self.__count)
+		_roundtrip()
+		stale = [entry['message_id'] for entry in pending if entry['time_since_delivered'] >= self.__claimidle and entry['consumer'] != self.consumer]
+		if not stale:
+			return
+		claimed = self.db.xclaim(self.key,self.group,self.consumer,self.__claimidle,stale)
+		_roundtrip()
+
+		#The claimed entries are listed in the order of the requested ids, omitting those that could not be claimed
+		#(e.g. claimed by another consumer meanwhile). Before redis 7, an entry trimmed from the stream while pending
+		#is claimed but listed empty, without its id; its id is recovered when the ids requested since the previous
+		#listed entry were all claimed, and the entry is then dropped from the pending list.
+		trimmed = []
+		position = 0
+		empty = 0
+		for entryid, fields in claimed:
+			if entryid == None:
+				empty += 1
+				continue
+			index = stale.index(entryid,position)
+			if empty == index-position:
+				trimmed += stale[position:index]
+			position = index+1
+			empty = 0
+			self.__buffer.append((entryid,fields['item']))
+		if empty > 0 and empty == len(stale)-position:
+			trimmed += stale[position:]
+
+		if trimmed:
+			self.db.xack(self.key,self.group,*trimmed)
+			_roundtrip()
+
+	def __fetch(self, block, timeout):
+		"""Fetch the next batch of entries into the buffer, acknowledging delivered entries if required."""
+		self.__claim()
+		if self.__buffer:
+			return
+
+		if not block:
+			blockms = None
+		elif timeout == None:
+			blockms = 0
+		else:
+			blockms = max(int(timeout*1000),1)
+
+		pipe = self.db.pipeline(transaction=False)
+		if self.__autoack and self.__delivered:
+			self.__ack(pipe)
+		pipe.xreadgroup(self.group,self.consumer,{self.key:'>'},count=self.__count,block=blockms)
+		streams = pipe.execute()[-1]
+		_roundtrip()
+
+		if streams:
+			for entryid, fields in streams[0][1]:
+				self.__buffer.append((entryid,fields['item']))
+
+	@_instrumented
+	def get(self, block=True, timeout=None):
+		"""Remove and return an item from the queue.
 
+		If optional args block is true and timeout is None (the default), block
+		if necessary until an item is available."""
+
+		if not self.__buffer:
+			self.__fetch(block,timeout)
+			if not self.__buffer:
+				return None
+
+		entryid, item = self.__buffer.popleft()
+		self.__delivered.append(entryid)
 		return item
 
+class PriorityQueue(_Structure):
+	"""
+	Implements structure that gets the item with the lowest priority first, on top of
+	a redis sorted set. Items with the same priority are gotten in the order they were put.
+	"""
+	__index = 0
+
+	#Atomically number the item and add it to the sorted set. The member is the zero-padded
+	#sequence number followed by the item, so that members are unique and equal priorities
+	#are ordered (lexicographically) by insertion.
+	PUT = """
+	local sequence = redis.call('INCR', KEYS[2])
+	redis.call('ZADD', KEYS[1], ARGV[1], string.format('%020d', sequence) .. ARGV[2])
+	"""
+
+	#Length of the sequence number prefixing the members.
+	SEQUENCELENGTH = 20
+
+	def __init__(self, name = None, namespace='priorityqueue', **redis_kwargs):
+		"""The default connection parameters are: host='localhost', port=6379, db=0"""
+
+		if name == None:
+			name = 'default%d' % PriorityQueue.__index
+			PriorityQueue.__index+=1
+
+		_Structure.__init__(self,name,namespace,**redis_kwargs)
+		if isinstance(self.db,SharedMemoryClient):
+			raise ValueError('PriorityQueue requires a redis backend.')
+
+		self.__put = self.db.register_script(PriorityQueue.PUT)
+
+	@_instrumented
+	def size(self):
+		"""Return the approximate size of the queue."""
+		_roundtrip()
+		return self.db.zcard(self.key)
+
+	@_instrumented
+	def put(self, item, priority=0):
+		"""Put item with the given (numerical) priority into the queue without blocking."""
+		self.__put(keys=[self.key,self.key+':sequence'],args=[priority,item])
+		_roundtrip()
+
+	def _canputunique(self):
+		return False
+
+	@_instrumented
+	def get(self, block=True, timeout=None):
+		"""Remove and return the item with the lowest priority from the queue.
+
+		If optional args block is true and timeout is None (the default), block
+		if necessary until an item is available."""
+
+		if block:
+			member = self.db.bzpopmin(self.key,timeout=timeout)
+			_roundtrip()
+			if not member:
+				return None
+			member = member[1]
+		else:
+			members = self.db.zpopmin(self.key)
+			_roundtrip()
+			if not members:
+				return None
+			member = members[0][0]
+		return member[PriorityQueue.SEQUENCELENGTH:]
+
+	@_instrumented
+	def getmany(self, n, block=True, timeout=None):
+		"""Remove and return a list of the (at most) n items with the lowest priorities.
+
+		Only blocks (see @get) until the first item is available."""
+
+		members = self.db.zpopmin(self.key,n)
+		_roundtrip()
+		if not members and block:
+			member = self.db.bzpopmin(self.key,timeout=timeout)
+			_roundtrip()
+			if member:
+				members = [member[1:]]
+				if n > 1:
+					members += self.db.zpopmin(self.key,n-1)
+					_roundtrip()
+
+		return [member[PriorityQueue.SEQUENCELENGTH:] for member, priority in members]
+
 class EncoderDecorator(_Structure):
 	"""
 	Structure decorator that encodes/decodes entries in some provided way.
@@ -134,31 +1071,79 @@ class EncoderDecorator(_Structure):
 		self.__structure = structure
 		self.__encoder = encoder
 
+	@_instrumented
 	def size(self):
 		return self.__structure.size()
 
+	@_instrumented
 	def empty(self):
 		return self.__structure.empty()
 
-	def put(self, item):
+	@_instrumented
+	def put(self, item, *args, **kwargs):
+		operation = _current()
+		if operation != None:
+			start = timeit.default_timer()
+		try:
+			encodeditem = self.__encoder.encode(item)
+		except Exception, e:
+			raise Exception('Could not encode item "'+str(item)+'" with provided encoder.',e)
+		if operation != None:
+			operation.codecseconds = timeit.default_timer() - start
+			operation.rawbytes = len(str(item))
+			operation.encodedbytes = len(encodeditem)
+		return self.__structure.put(encodeditem, *args, **kwargs)
+
+	@_instrumented
+	def putunique(self, item, filtername, ttl, positions=None, previous=None):
 		try:
 			encodeditem = self.__encoder.encode(item)
 		except Exception, e:
 			raise Exception('Could not encode item "'+str(item)+'" with provided encoder.',e)
-		self.__structure.put(encodeditem)
+		return self.__structure.putunique(encodeditem,filtername,ttl,positions,previous)
 
+	def _canputunique(self):
+		return self.__structure._canputunique()
+
+	@_instrumented
 	def get(self, block=True, timeout=None):
 		encodeditem = self.__structure.get(block,timeout)
 		
 		if encodeditem == None:
 			return encodeditem
 
+		operation = _current()
+		if operation != None:
+			start = timeit.default_timer()
 		try:
 			decodeditem = self.__encoder.decode(encodeditem)
 		except Exception, e:
 			raise Exception('Could not decode item "'+str(encodeditem)+'" with provided encoder.',e)
+		if operation != None:
+			operation.codecseconds = timeit.default_timer() - start
+			operation.rawbytes = len(str(decodeditem))
+			operation.encodedbytes = len(encodeditem)
 		return decodeditem
 
+	@_instrumented
+	def getmany(self, n, block=True, timeout=None):
+		encodeditems = self.__structure.getmany(n,block,timeout)
+
+		operation = _current()
+		if operation != None:
+			start = timeit.default_timer()
+		decodeditems = []
+		for encodeditem in encodeditems:
+			try:
+				decodeditems.append(self.__encoder.decode(encodeditem))
+			except Exception, e:
+				raise Exception('Could not decode item "'+str(encodeditem)+'" with provided encoder.',e)
+		if operation != None:
+			operation.codecseconds = timeit.default_timer() - start
+			operation.rawbytes = sum(len(str(decodeditem)) for decodeditem in decodeditems)
+			operation.encodedbytes = sum(len(encodeditem) for encodeditem in encodeditems)
+		return decodeditems
+
 class JSONEncoder(object):
 	"""
 	JSON encoder to use with encoder decorator.
@@ -182,10 +1167,90 @@ class ZlibEncoder(object):
 		return eval(zlib.decompress(item))
 
 
+class _DedupFilter(object):
+	"""
+	Membership filter of the items recently put in each of the structures of a MultiStruct.
+	Since an item is always routed to the same structure, each structure has its own filter.
+
+	In 'bloom' mode, the filter of a structure is a bloom filter stored as a redis bitmap, which
+	is replaced every window seconds. An item is dropped if it is in the current or the previous
+	bitmap, so duplicates are dropped for at least window (and at most twice window) seconds after
+	an item is put. Bitmaps are mirrored in local bit arrays so that items this client already put
+	are dropped without a round trip. In 'exact' mode, each item has its own marker expiring window
+	seconds after it was first put.
+	"""
+
+	def __init__(self, mode, n, window, errorrate, membytes):
+		"""
+		mode - either 'bloom' or 'exact'.
+		n - the number of structures.
+		window - the duration, in seconds, during which duplicates are dropped.
+		errorrate - the bloom filter false positive rate once it holds as many items as its memory allows.
+		membytes - the memory budget, in bytes, of the bloom filters, shared by all the structures and by the
+			two generations (current and previous window) of their filters. It is used both on the server and,
+			for the mirrors, in the client. With m bits per structure and generation, each filter holds about
+			m*ln(2)^2/-ln(errorrate) items.
+		"""
+		if mode not in ['bloom','exact']:
+			raise ValueError('Unknown deduplication mode "%s", must be "bloom" or "exact".' % mode)
+		if not 0 < errorrate < 1:
+			raise ValueError('Provided error rate (%f) must be in (0,1).' % errorrate)
+		if window <= 0:
+			raise ValueError('Provided deduplication window (%s) must be strictly positive.' % str(window))
+
+		self.mode = mode
+		self.window = int(math.ceil(window))
+
+		#Bits per structure and generation (a redis bitmap holds at most 2^32 bits) and number of hash functions.
+		self.__bits = max(min(membytes*8/(2*n),2**32),8)
+		self.__hashes = max(int(round(-math.log(errorrate,2))),1)
+
+		#Current window and the local mirror of each structure's bloom filter for that window and the previous one.
+		self.__generation = None
+		self.__mirrors = [None]*n
+		self.__previousmirrors = [None]*n
+
+	def __refresh(self):
+		generation = int(time.time()/self.window)
+		if generation != self.__generation:
+			if self.__generation == generation-1:
+				self.__previousmirrors = self.__mirrors
+			else:
+				self.__previousmirrors = [None]*len(self.__mirrors)
+			self.__generation = generation
+			self.__mirrors = [None]*len(self.__mirrors)
+
+	def mark(self, i, s):
+		"""Return the (filter name,ttl,positions,previous filter name) filter arguments of the string s
+		put in the i-th structure, or None if it is known to be a duplicate."""
+		if self.mode == 'exact':
+			return ('dedup:%032x' % (mmh3.hash128(s) & (2**128-1)),self.window,None,None)
+
+		self.__refresh()
+		h1, h2 = mmh3.hash64(s)
+		positions = [(h1+j*h2) % self.__bits for j in range(self.__hashes)]
+
+		for mirror in [self.__mirrors[i],self.__previousmirrors[i]]:
+			if mirror != None and all(mirror[p >> 3] & (1 << (p & 7)) for p in positions):
+				return None
+
+		#A bitmap is looked up during its window and the next one.
+		return ('bloom:%d' % self.__generation,2*self.window,positions,'bloom:%d' % (self.__generation-1))
+
+	def add(self, i, positions):
+		"""Record the given positions as set in the local mirror of the i-th structure's filter."""
+		if positions == None:
+			return
+		if self.__mirrors[i] == None:
+			self.__mirrors[i] = bytearray((self.__bits+7)/8)
+		mirror = self.__mirrors[i]
+		for p in positions:
+			mirror[p >> 3] |= 1 << (p & 7)
+
 class MultiStruct(_Structure):
 	"""Use multiple structures through a single structure, load balancing with a hash function."""
 
-	def __init__(self,structures,hashf=None,preserve=False):		
+	def __init__(self,structures,hashf=None,preserve=False,dedup=None,window=3600,errorrate=0.001,membytes=2**22):
 		"""
 		structures - list of structure to use (size at least 2).
 		hashf - hash function to use for load balancing. 
@@ -193,7 +1258,19 @@ class MultiStruct(_Structure):
 		preserve - whether to preserve the structures' properties. If 'True', then
 			all the provided structures must be of the same type, one of the provided
 			structure will be set aside and used to honor 'put'/'get' order (so there must
-			be at least 3 structures). If 'False', then 'get' returns item a random structure.
+			be at least 3 structures). If 'False', then 'get' returns item a random structure,
+			so for instance @PriorityQueue priorities are only honored within each structure.
+		dedup - whether to drop items put again within the deduplication window. If 'bloom', a
+			bloom filter of the items is kept with each structure, which may drop a few unique
+			items (see errorrate); if 'exact', a marker is kept for every item. If 'None', items
+			are not deduplicated. Requires list based structures (e.g. @Queue, @Stack) on redis, and
+			cannot be combined with preserve since the operations structure would not be updated
+			atomically with the deduplicated put.
+		window - the deduplication window, in seconds. Bloom filters are replaced every window,
+			so duplicates are dropped for between one and two windows.
+		errorrate - the bloom filters false positive rate when filled to the memory budget.
+		membytes - the memory budget, in bytes, of the bloom filters of all the structures, used
+			both on the server and in this client (see @_DedupFilter).
 		"""
 		self.__opstruct = None
 		if preserve:
@@ -221,33 +1298,65 @@ class MultiStruct(_Structure):
 		else:
 			self.__hashf = hashf
 
+		self.__dedup = None
+		if dedup != None:
+			if preserve:
+				raise ValueError('Deduplicating MultiStruct composer cannot preserve the structures properties.')
+			for structure in self.__structures:
+				if not structure._canputunique():
+					raise ValueError('Deduplicating MultiStruct composer requires list based structures on redis, got "%s".' % type(structure).__name__)
+			self.__dedup = _DedupFilter(dedup,len(self.__structures),window,errorrate,membytes)
 
+	def _canputunique(self):
+		return False
+
+	@_instrumented
 	def size(self):
 		s = 0
 		for structure in self.__structures:
 			s += structure.size()
 		return s
 
+	@_instrumented
 	def empty(self):
 		"""Return True if the queue is empty, False otherwise."""
 		return self.size() == 0
 
-	def put(self, item):
-		"""Put item into the queue without blocking."""
-		h = self.__hashf(str(item))
+	@_instrumented
+	def put(self, item, *args, **kwargs):
+		"""Put item into the queue without blocking.
+
+		Additional arguments (e.g. a @PriorityQueue item's priority) are passed to the structures' put.
+		Return False if the item was dropped as a duplicate, True otherwise."""
+		s = str(item)
+		h = self.__hashf(s)
 		i = h % len(self.__structures)
 		assert i >= 0 and i < len(self.__structures), 'Calculated index "%s" from hash "%s" for item "%s" is not a proper index into %d structures' % (str(i),h,item,len(self.__structures))
 
 		structure = self.__structures[i]
 
+		if self.__dedup != None:
+			mark = self.__dedup.mark(i,s)
+			if mark == None:
+				return False
+			filtername, ttl, positions, previous = mark
+			put = structure.putunique(item,filtername,ttl,positions,previous)
+			self.__dedup.add(i,positions)
+			return put
+
 		if self.__opstruct != None:
-			self.__opstruct.put(i)
+			self.__opstruct.put(i, *args, **kwargs)
 
-		structure.put(item)
+		structure.put(item, *args, **kwargs)
+		return True
 
+	@_instrumented
 	def get(self, block=True, timeout=None):
 		if self.__opstruct != None:
-			i = int(self.__opstruct.get(block,timeout))
+			i = self.__opstruct.get(block,timeout)
+			if i == None:
+				return None
+			i = int(i)
 			assert i >= 0 and i < len(self.__structures), 'Index "%s" obtained from operations structure is not a proper index into %d structures' % (str(i),len(self.__structures))
 			structure = self.__structures[i]
 		else:
@@ -339,6 +1448,120 @@ def testStack():
 	assert S.size() == 0, 'Empty queue does not have size 0.'
 
 
+def testStreamQueue():
+	Q = StreamQueue(count=128)
+
+	assert Q.empty(), 'Fresh queue is not empty.'
+	assert Q.size() == 0, 'Fresh queue does not have size 0.'
+
+	for item in items:
+		Q.put(item)
+
+	qsize = Q.size()
+	assert qsize == len(items), 'Got queue size %d, expected %d.' % (qsize,len(items))
+
+	for item in items:
+		qitem = Q.get()
+		assert qitem == item, 'Got item "%s", expected "%s".' % (qitem,item)
+
+	qitem = Q.get(block=False)
+	assert qitem == None, 'Got item "%s" from exhausted queue, expected None.' % qitem
+
+	Q.ack()
+	assert Q.empty(), 'Queue not empty after removing and acknowledging all items.'
+
+	#Acknowledged items stay in the stream for other consumer groups.
+	replay = StreamQueue(Q.key.split(':',1)[1],group='replay')
+	qsize = replay.size()
+	assert qsize == len(items), 'Got replay queue size %d, expected %d.' % (qsize,len(items))
+	qitem = replay.get(block=False)
+	assert qitem == items[0], 'Got replayed item "%s", expected "%s".' % (qitem,items[0])
+
+	#Items delivered to a consumer that never acknowledges them are claimed by another consumer.
+	crashed = StreamQueue(Q.key.split(':',1)[1],consumer='crashed',autoack=False)
+	worker = StreamQueue(Q.key.split(':',1)[1],consumer='worker',claimidle=0)
+
+	n = 10
+	for item in items[:n]:
+		Q.put(item)
+	for item in items[:n]:
+		qitem = crashed.get()
+		assert qitem == item, 'Got item "%s", expected "%s".' % (qitem,item)
+
+	for item in items[:n]:
+		qitem = worker.get(block=False)
+		assert qitem == item, 'Got claimed item "%s", expected "%s".' % (qitem,item)
+
+	worker.ack()
+	assert Q.empty(), 'Empty queue is not empty.'
+	assert Q.size() == 0, 'Empty queue does not have size 0.'
+
+	#Items trimmed from the stream while pending are dropped by the consumer claiming them.
+	crashed = StreamQueue(Q.key.split(':',1)[1],consumer='crashed',autoack=False)
+	for item in items[:n]:
+		Q.put(item)
+	for item in items[:n]:
+		crashed.get()
+	Q.db.xtrim(Q.key,0,approximate=False)
+	worker = StreamQueue(Q.key.split(':',1)[1],consumer='worker',claimidle=0)
+	qitem = worker.get(block=False)
+	assert qitem == None, 'Got trimmed item "%s".' % qitem
+	assert Q.empty(), 'Queue with only trimmed items is not empty.'
+	assert Q.size() == 0, 'Queue with only trimmed items does not have size 0.'
+
+	Q.db.delete(Q.key)
+
+def testPriorityQueue():
+	Q = PriorityQueue()
+
+	assert Q.empty(), 'Fresh queue is not empty.'
+	assert Q.size() == 0, 'Fresh queue does not have size 0.'
+
+	#Put the items with decreasing priorities, in groups of equal priority.
+	group = 10
+	for i, item in enumerate(items):
+		Q.put(item,len(items)/group-i/group)
+
+	qsize = Q.size()
+	assert qsize == len(items), 'Got queue size %d, expected %d.' % (qsize,len(items))
+
+	expected = []
+	for i in range(0,len(items),group):
+		expected = items[i:i+group] + expected
+
+	qitems = Q.getmany(group)
+	assert qitems == expected[:group], 'Got items "%s", expected "%s".' % (qitems,expected[:group])
+	for item in expected[group:]:
+		qitem = Q.get()
+		assert qitem == item, 'Got item "%s", expected "%s".' % (qitem,item)
+
+	assert Q.empty(), 'Queue not empty after removing all items.'
+	assert Q.get(block=False) == None, 'Got an item from an empty queue.'
+	assert Q.getmany(group,timeout=1) == [], 'Got items from an empty queue.'
+
+	#Priorities are honored through an encoder and a property preserving MultiStruct.
+	Qnum = 5
+	Q = EncoderDecorator(MultiStruct([PriorityQueue() for num in range(Qnum)],preserve = True),JSONEncoder())
+
+	registry = MetricsRegistry()
+	addHook(registry)
+
+	n = 10
+	for i in range(n):
+		Q.put({'task':i},n-i)
+	for i in reversed(range(n)):
+		qitem = Q.get()
+		assert qitem == {'task':i}, 'Got item "%s", expected "%s".' % (qitem,{'task':i})
+	removeHook(registry)
+
+	count = registry.value('qredis_operations_total','PriorityQueue','get')
+	assert count == 2*n, 'Got %d recorded priority queue gets, expected %d.' % (count,2*n)
+	count = registry.value('qredis_operations_total','PriorityQueue','getmany')
+	assert count == 0, 'Got %d recorded priority queue getmany for gets, expected none.' % count
+
+	assert Q.empty(), 'Empty queue is not empty.'
+	assert Q.size() == 0, 'Empty queue does not have size 0.'
+
 def testMultiStruct():
 	Qnum = 5
 	Qs = [Queue() for num in range(Qnum)]
@@ -383,6 +1606,169 @@ def testMultiStruct():
 	assert Q.size() == 0, 'Empty queue does not have size 0.'	
 
 
+def testDedup():
+	structures = []
+	for dedup in ['bloom','exact']:
+		Qnum = 5
+		Qs = [Queue() for num in range(Qnum)]
+		structures += Qs
+		Q = MultiStruct(Qs,dedup = dedup)
+
+		for item in items:
+			assert Q.put(item), 'Unique item "%s" was dropped.' % item
+		for item in items:
+			assert not Q.put(item), 'Duplicate item "%s" was put.' % item
+
+		#Another producer over the same structures also drops the duplicates.
+		P = MultiStruct([Queue(q.key.split(':',1)[1]) for q in Qs],dedup = dedup)
+		for item in items[:100]:
+			assert not P.put(item), 'Duplicate item "%s" from another producer was put.' % item
+
+		qsize = Q.size()
+		assert qsize == len(items), 'Got queue size %d, expected %d.' % (qsize,len(items))
+
+		qitems = []
+		while len(qitems) < len(items):
+			qitem = Q.get(block=False)
+			if qitem != None:
+				qitems.append(qitem)
+		assert sorted(qitems) == sorted(items), 'Got items different from the unique items put.'
+
+		assert Q.empty(), 'Empty queue is not empty.'
+
+		#Items are deduplicated for at least the window, even across a bloom filter replacement...
+		Qs = [Queue() for num in range(Qnum)]
+		structures += Qs
+		Q = EncoderDecorator(MultiStruct(Qs,dedup = dedup,window = 1),JSONEncoder())
+		time.sleep(math.ceil(time.time())-time.time()+0.05)
+		assert Q.put(items[0]), 'Unique item "%s" was dropped.' % items[0]
+		time.sleep(0.9)
+		assert not Q.put(items[0]), 'Duplicate item "%s" was put in the next window.' % items[0]
+		P = EncoderDecorator(MultiStruct([Queue(q.key.split(':',1)[1]) for q in Qs],dedup = dedup,window = 1),JSONEncoder())
+		assert not P.put(items[0]), 'Duplicate item "%s" from another producer was put in the next window.' % items[0]
+
+		#...but not after it.
+		time.sleep(2)
+		assert Q.put(items[0]), 'Item "%s" put again after the window was dropped.' % items[0]
+
+	#Only list based structures on redis support deduplication, and not with an operations structure.
+	streamqueues = [StreamQueue() for num in range(2)]
+	structures += streamqueues
+	for kwargs in [{'structures':streamqueues},{'structures':[PriorityQueue() for num in range(2)]},{'structures':[Queue(url='shm://') for num in range(2)]},{'structures':[Queue() for num in range(3)],'preserve':True}]:
+		try:
+			MultiStruct(dedup = 'bloom',**kwargs)
+		except ValueError:
+			pass
+		else:
+			raise AssertionError('Deduplicating MultiStruct composer accepted %s.' % kwargs)
+
+	#Remove the structures and their filters.
+	for structure in structures:
+		structure.db.delete(structure.key,*structure.db.scan_iter(match=structure.key+':*'))
+
+def _produce(name, url, items):
+	Q = Queue(name,url=url)
+	for item in items:
+		Q.put(item)
+	Q.db.close()
+
+def testSharedMemory():
+	#A small buffer, so that records wrap around its end and the producer waits for room. Blocked
+	#processes only retry every 10 seconds, so the items must flow through wakeups.
+	url = 'shm://?capacity=4096&poll=10'
+
+	Q = Queue(url=url)
+	S = Stack(url=url)
+	Qs = [Queue(url=url) for num in range(5)]
+	M = MultiStruct(Qs,preserve = True)
+
+	for structure, expected in [(Q,items[:100]),(S,list(reversed(items[:100]))),(M,items[:100])]:
+		assert structure.empty(), 'Fresh structure is not empty.'
+		for item in items[:100]:
+			structure.put(item)
+		qsize = structure.size()
+		assert qsize == 100, 'Got size %d, expected %d.' % (qsize,100)
+		for item in expected:
+			qitem = structure.get()
+			assert qitem == item, 'Got item "%s", expected "%s".' % (qitem,item)
+		assert structure.empty(), 'Structure not empty after removing all items.'
+		assert structure.get(block=False) == None, 'Got an item from an empty structure.'
+
+	assert Q.get(timeout=0.1) == None, 'Got an item from an empty queue.'
+
+	#Items flow through the buffer from another process, which blocks while the buffer is full.
+	producer = multiprocessing.Process(target=_produce,args=(Q.key.split(':',1)[1],url,items))
+	start = time.time()
+	producer.start()
+	for item in items:
+		qitem = Q.get(timeout=10)
+		assert qitem == item, 'Got item "%s", expected "%s".' % (qitem,item)
+	producer.join()
+	assert time.time()-start < 10, 'Items took %.1f seconds to flow between processes.' % (time.time()-start)
+
+	assert Q.empty(), 'Empty queue is not empty.'
+	for structure in [Q,S]+Qs:
+		structure.db.delete(structure.key)
+
+	#Closing the clients releases the buffers' file descriptors.
+	fds = len(os.listdir('/proc/self/fd'))
+	for num in range(100):
+		Q = Queue(url=url)
+		Q.put(items[0])
+		Q.get()
+		Q.db.delete(Q.key)
+		Q.db.close()
+	assert len(os.listdir('/proc/self/fd')) == fds, 'Leaked %d file descriptors.' % (len(os.listdir('/proc/self/fd'))-fds)
+
+def testInstrumentation():
+	Qnum = 5
+	Q = EncoderDecorator(MultiStruct([Queue() for num in range(Qnum)],preserve = True),JSONEncoder())
+
+	def failinghook(operation):
+		raise Exception('Failing hook.')
+
+	registry = MetricsRegistry()
+	addHook(failinghook)
+	addHook(registry)
+	try:
+		n = 10
+		for item in items[:n]:
+			Q.put(item)
+		for item in items[:n]:
+			qitem = Q.get()
+			assert qitem == item, 'Got item "%s", expected "%s".' % (qitem,item)
+		assert Q.empty(), 'Queue not empty after removing all items.'
+	finally:
+		removeHook(registry)
+		removeHook(failinghook)
+
+	Q.put(items[0])
+	Q.get()
+
+	count = registry.value('qredis_operations_total','EncoderDecorator','put')
+	assert count == n, 'Got %d recorded puts, expected %d.' % (count,n)
+
+	#Every put and get on a property preserving MultiStruct goes to the operations structure and to one of the structures.
+	for operation in ['put','get']:
+		roundtrips = registry.value('qredis_roundtrips_total','EncoderDecorator',operation)
+		assert roundtrips == 2*n, 'Got %d round trips for %d %s, expected %d.' % (roundtrips,n,operation,2*n)
+		roundtrips = registry.value('qredis_roundtrips_total','Queue',operation)
+		assert roundtrips == 2*n, 'Got %d round trips for %d queue %s, expected %d.' % (roundtrips,n,operation,2*n)
+
+	rawbytes = registry.value('qredis_raw_bytes_total','EncoderDecorator','put')
+	encodedbytes = registry.value('qredis_encoded_bytes_total','EncoderDecorator','put')
+	assert rawbytes == sum(len(item) for item in items[:n]), 'Got %d raw bytes put.' % rawbytes
+	assert encodedbytes == rawbytes+2*n, 'Got %d encoded bytes put, expected %d.' % (encodedbytes,rawbytes+2*n)
+
+	total, count = registry.value('qredis_operation_seconds','MultiStruct','get')
+	assert count == n, 'Got %d recorded MultiStruct get latencies, expected %d.' % (count,n)
+	total, count = registry.value('qredis_operation_seconds','MultiStruct','getmany')
+	assert (total,count) == (0.0,0), 'Got %d recorded MultiStruct getmany latencies, expected none.' % count
+
+	text = registry.render()
+	assert '# TYPE qredis_operation_seconds histogram' in text, 'Rendered metrics are missing the latency histogram.'
+	assert 'qredis_operations_total{structure="Queue",operation="put"} %d' % (2*n) in text, 'Rendered metrics are missing the queue put counter.'
+	assert 'qredis_operation_seconds_bucket{structure="MultiStruct",operation="get",le="+Inf"} %d' % n in text, 'Rendered metrics are missing the MultiStruct get latencies.'
 
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.stats
+
+import mypyutils
+
+
+def testSummary():
+    for n in [1,2,10,101]:
+        data = np.random.rand(n)
+        summary = mypyutils.stats.Summary(data)
+
+        #Percentiles falling on and between data points.
+        for q in [0,5,25,33.3,50,75,99,100]:
+            expected = scipy.stats.scoreatpercentile(data,q)
+            assert np.allclose(summary.percentile(q),expected), 'Got %d-th percentile %f of %d points, expected %f.' % (q,summary.percentile(q),n,expected)
+
+        assert np.allclose(summary.mean(),np.mean(data)), 'Got mean %f, expected %f.' % (summary.mean(),np.mean(data))
+        assert np.allclose(summary.variance(),np.var(data)), 'Got variance %f, expected %f.' % (summary.variance(),np.var(data))
+
+        x, y = summary.ecdf()
+        assert np.all(x == np.sort(data)), 'ECDF is not over the sorted data.'
+        assert y[-1] == 1.0, 'ECDF does not reach 1.'
+
+    #Infinite values (e.g. capped at a timeout) only affect the percentiles interpolated with them.
+    data = [1,2,np.inf]
+    summary = mypyutils.stats.Summary(data)
+    for q in [0,25,50,75,100]:
+        expected = scipy.stats.scoreatpercentile(data,q)
+        assert summary.percentile(q) == expected, 'Got %d-th percentile %f of %s, expected %f.' % (q,summary.percentile(q),data,expected)
+
+def testSummaryCache():
+    data = [np.random.rand(100) for i in range(3)]
+    nbytes = mypyutils.stats.Summary(data[0]).nbytes
+
+    #Room for two summaries, the least recently used one is evicted.
+    cache = mypyutils.stats.SummaryCache(maxbytes=2*nbytes)
+    summaries = [cache.get(d) for d in data[:2]]
+    assert cache.get(list(data[0])) is summaries[0], 'Summary of equal data was not cached.'
+    summaries.append(cache.get(data[2]))
+    assert cache.nbytes == 2*nbytes, 'Got cache of %d bytes, expected %d.' % (cache.nbytes,2*nbytes)
+    assert cache.get(data[0]) is summaries[0], 'Recently used summary was evicted.'
+    assert cache.get(data[2]) is summaries[2], 'Last summary was evicted.'
+    assert cache.get(data[1]) is not summaries[1], 'Least recently used summary was not evicted.'
+    assert cache.nbytes == 2*nbytes, 'Got cache of %d bytes, expected %d.' % (cache.nbytes,2*nbytes)
+
+    #Evicted summaries are spilled to disk and reloaded.
+    spilldir = tempfile.mkdtemp()
+    try:
+        cache = mypyutils.stats.SummaryCache(maxbytes=nbytes,spilldir=spilldir)
+        summary = cache.get(data[0])
+        cache.get(data[1])
+        key = mypyutils.stats.SummaryCache.fingerprint(data[0])[0]
+        assert os.path.exists(os.path.join(spilldir,key+'.npy')), 'Evicted summary was not spilled.'
+        reloaded = cache.get(data[0])
+        assert reloaded is not summary, 'Evicted summary was still cached.'
+        assert np.all(reloaded.sorted == summary.sorted), 'Spilled summary was not reloaded as saved.'
+        assert reloaded.percentile(50) == summary.percentile(50), 'Got median %f from spilled summary, expected %f.' % (reloaded.percentile(50),summary.percentile(50))
+    finally:
+        shutil.rmtree(spilldir)
+
+def testsummarize():
+    data = np.random.rand(100)
+    summary = mypyutils.stats.summarize(data)
+    assert mypyutils.stats.summarize(data.copy()) is summary, 'Summary of equal data was not shared.'
+    assert mypyutils.stats.summarize(data[::-1]) is not summary, 'Summary of different data was shared.'
+
+testSummary()
+testSummaryCache()
+testsummarize()
@@ -5,6 +5,11 @@ Various statistical related utilities.
 import numpy as np
 import scipy as stats
 import random
+import math
+import os
+import hashlib
+import threading
+import collections
 
 def bootstrap(data,n=None,seed=None):
     """Return a bootstrap sample in list form of the provided data.
@@ -32,3 +37,175 @@ def bootstrap(data,n=None,seed=None):
 
     return bs
 
+
+class Summary(object):
+    """Summary statistics of some data, all derived from a single sorted copy of the data.
+
+    The statistics are computed on first use and then kept, so they should be obtained
+    through summarize() to be shared between calls on the same data.
+    """
+
+    def __init__(self,data,presorted=False):
+        """Create the summary of the provided data.
+
+        Arguments:
+        data -- a sequence of real data samples.
+
+        Keyword Arguments:
+        presorted -- whether the data is already a sorted float array.
+        """
+        if presorted:
+            self.sorted = data
+        else:
+            self.sorted = np.sort(np.asarray(data,dtype=float),axis=None)
+        self.sorted.setflags(write=False)
+        self.n = len(self.sorted)
+
+        self.__percentiles = {}
+        self.__moments = {}
+        self.__ecdf = None
+
+    @property
+    def nbytes(self):
+        """The memory footprint of the summary, that is of the sorted data and its ECDF."""
+        return 2*self.sorted.nbytes
+
+    def percentile(self,q):
+        """Return the q-th percentile of the data, interpolating linearly between data points
+        (same as scipy.stats.scoreatpercentile).
+
+        Arguments:
+        q -- the percentile, in [0,100].
+        """
+        if not 0<=q<=100:
+            raise Exception('Provided percentile (%s) must be in [0,100].' % str(q))
+        if q not in self.__percentiles:
+            if self.n == 0:
+                value = np.nan
+            else:
+                index = q/100.0*(self.n-1)
+                i = int(math.floor(index))
+                value = self.sorted[i]
+                #Only interpolate between distinct data points, so that infinite neighbours do not give nan.
+                if index > i and i+1 < self.n:
+                    value = value + (self.sorted[i+1]-value)*(index-i)
+            self.__percentiles[q] = value
+        return self.__percentiles[q]
+
+    def moment(self,k):
+        """Return the k-th central moment of the data (k=1 gives the mean instead).
+
+        Arguments:
+        k -- the order of the moment.
+        """
+        if k not in self.__moments:
+            if k == 1:
+                self.__moments[k] = np.mean(self.sorted)
+            else:
+                self.__moments[k] = np.mean((self.sorted-self.mean())**k)
+        return self.__moments[k]
+
+    def mean(self):
+        """Return the mean of the data."""
+        return self.moment(1)
+
+    def variance(self):
+        """Return the (population) variance of the data."""
+        return self.moment(2)
+
+    def ecdf(self):
+        """Return the x and y vertices of the empirical cumulative distribution function of the data."""
+        if self.__ecdf == None:
+            y = np.arange(1,self.n+1)/float(max(self.n,1))
+            y.setflags(write=False)
+            self.__ecdf = (self.sorted,y)
+        return self.__ecdf
+
+class SummaryCache(object):
+    """Least recently used cache of data summaries, keyed by a fingerprint of the data's content.
+
+    Summaries evicted from the cache can be spilled to disk as .npy files of the sorted data,
+    so that they are reloaded instead of sorting the data again.
+    """
+
+    def __init__(self,maxbytes=2**28,spilldir=None):
+        """Create a summary cache.
+
+        Keyword Arguments:
+        maxbytes -- the memory budget of the cached summaries, in bytes.
+        spilldir -- the directory to spill evicted summaries to, if None evicted summaries are dropped.
+        """
+        if maxbytes < 0:
+            raise Exception('Provided cache memory budget maxbytes (%d) must be positive.' % maxbytes)
+        if spilldir != None and not os.path.isdir(spilldir):
+            os.makedirs(spilldir)
+
+        self.maxbytes = maxbytes
+        self.spilldir = spilldir
+        self.nbytes = 0
+
+        self.__lock = threading.Lock()
+        self.__summaries = collections.OrderedDict()
+
+    @staticmethod
+    def fingerprint(data):
+        """Return the fingerprint of the data's content and its contiguous float array.
+
+        Arguments:
+        data -- a sequence of real data samples.
+        """
+        data = np.ascontiguousarray(data,dtype=float).ravel()
+        return '%s-%d' % (hashlib.sha1(data).hexdigest(),len(data)), data
+
+    def __spillpath(self,key):
+        return os.path.join(self.spilldir,key+'.npy')
+
+    def get(self,data):
+        """Return the summary of the provided data, from the cache if possible.
+
+        Arguments:
+        data -- a sequence of real data samples.
+        """
+        key, data = SummaryCache.fingerprint(data)
+
+        with self.__lock:
+            summary = self.__summaries.pop(key,None)
+            if summary != None:
+                self.__summaries[key] = summary
+                return summary
+
+        if self.spilldir != None and os.path.exists(self.__spillpath(key)):
+            summary = Summary(np.load(self.__spillpath(key)),presorted=True)
+        else:
+            summary = Summary(data)
+
+        with self.__lock:
+            if key not in self.__summaries and summary.nbytes <= self.maxbytes:
+                self.__summaries[key] = summary
+                self.nbytes += summary.nbytes
+                self.__evict()
+        return summary
+
+    def __evict(self):
+        while self.nbytes > self.maxbytes:
+            key, summary = self.__summaries.popitem(last=False)
+            self.nbytes -= summary.nbytes
+            if self.spilldir != None and not os.path.exists(self.__spillpath(key)):
+                np.save(self.__spillpath(key),summary.sorted)
+
+    def clear(self):
+        """Drop all the cached summaries (spilled summaries are kept)."""
+        with self.__lock:
+            self.__summaries.clear()
+            self.nbytes = 0
+
+#Summary cache shared by the statistical and plotting utilities, replace it to change its budget or spill directory.
+cache = SummaryCache()
+
+def summarize(data):
+    """Return the (shared, cached) summary of the provided data, see Summary.
+
+    Arguments:
+    data -- a sequence of real data samples.
+    """
+    return cache.get(data)